@@ -19,15 +19,28 @@ modificação não autorizada é estritamente proibida sem consentimento prévio
 """
 import streamlit as st
 import pandas as pd
+import numpy as np
 import re
+import json
 import pdfplumber
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import altair as alt
 import matplotlib.pyplot as plt
 import tempfile
 import os
+import copy
+import threading
+import logging
+from zipfile import BadZipFile
+from collections import deque, defaultdict
+from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import lru_cache
 from fpdf import FPDF
+from pdfminer.psparser import PSException
+from pdfplumber.utils.exceptions import PdfminerException
+from openpyxl.utils.exceptions import InvalidFileException
 import time
 from datetime import datetime
 
@@ -45,6 +58,11 @@ def formatar_moeda(valor):
     texto = f"{valor:,.2f}"
     return f"R$ {texto.replace(',', 'X').replace('.', ',').replace('X', '.')}"
 
+def formatar_valor_br(valor):
+    """Formata float no padrão BR sem símbolo (X.XXX,XX); negativos entre parênteses"""
+    texto = f"{abs(valor):,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.')
+    return f"({texto})" if valor < 0 else texto
+
 def formatar_numero_br(valor):
     """Formata apenas número para gráficos (X.XXX)"""
     texto = f"{valor:,.0f}"
@@ -266,61 +284,127 @@ def listar_modelos_disponiveis(api_key):
     except:
         return []
 
+# --- PROMPT IA ---
+# Instrução fixa enviada via system_instruction; o conteúdo do usuário leva apenas os dados (JSON)
+SYSTEM_INSTRUCTION_IA = """Atue como um Analista Financeiro da INOVALENIN.
+Sua tarefa é gerar um Relatório Gerencial detalhado a partir dos dados em JSON enviados pelo usuário.
+Valores monetários em R$; campos terminados em _pct são percentuais.
+O bloco "atual" traz o período analisado. Se houver os blocos "anterior" e "variacao_pct" (variação do atual sobre o anterior), você DEVE criar uma seção específica comparando os dois períodos.
+ESTRUTURA OBRIGATÓRIA (Markdown):
+# 1. Identificação e Contexto
+[Cite Nome, CNPJ e Período]
+# 2. Análise da Saúde Financeira (Liquidez e Endividamento)
+[Análise focada em solvência]
+# 3. Análise de Performance Operacional (DRE)
+[Análise de margens, custos e lucro]
+# 4. Análise de Evolução (Comparativo)
+[Se houver dados, compare. Senão, analise sustentabilidade.]
+# 5. Conclusão Técnica e Recomendações
+## 5.1 Plano de Ação Imediato
+---
+Recomendamos que este relatório seja discutido com a contabilidade da empresa. Acesse www.inovalenin.com.br."""
+
+def calc_var(atual, anterior):
+    if anterior == 0: return 0.0
+    return ((atual - anterior) / anterior) * 100
+
+def montar_dados_ia(kpis, dados_dre, nome_empresa, cnpj_empresa, periodo_analise, dre_ant=None, kpis_ant=None):
+    """Monta o conteúdo compacto (JSON sem espaços) enviado à IA, com as variações YoY já calculadas"""
+    dados = {
+        "empresa": nome_empresa,
+        "cnpj": cnpj_empresa,
+        "periodo": periodo_analise,
+        "atual": {
+            "liquidez_corrente": round(kpis['Liquidez Corrente'], 2),
+            "liquidez_geral": round(kpis['Liquidez Geral'], 2),
+            "endividamento_pct": round(kpis['Endividamento Geral (%)'], 1),
+            "receita_liquida": round(dados_dre.receita_liquida, 2),
+            "lucro_bruto": round(dados_dre.lucro_bruto, 2),
+            "margem_bruta_pct": round(kpis['Margem Bruta (%)'], 1),
+            "ebit": round(dados_dre.resultado_operacional, 2),
+            "margem_operacional_pct": round(kpis['Margem Operacional (%)'], 1),
+            "lucro_liquido": round(dados_dre.lucro_liquido, 2),
+            "margem_liquida_pct": round(kpis['Margem Líquida (%)'], 1),
+            "gao": round(kpis['GAO (Alavancagem)'], 2),
+        },
+    }
+    if dre_ant and kpis_ant:
+        dados["anterior"] = {
+            "receita_liquida": round(dre_ant.receita_liquida, 2),
+            "lucro_liquido": round(dre_ant.lucro_liquido, 2),
+            "ebit": round(dre_ant.resultado_operacional, 2),
+            "margem_liquida_pct": round(kpis_ant['Margem Líquida (%)'], 1),
+        }
+        dados["variacao_pct"] = {
+            "receita_liquida": round(calc_var(dados_dre.receita_liquida, dre_ant.receita_liquida), 2),
+            "lucro_liquido": round(calc_var(dados_dre.lucro_liquido, dre_ant.lucro_liquido), 2),
+            "ebit": round(calc_var(dados_dre.resultado_operacional, dre_ant.resultado_operacional), 2),
+        }
+    return json.dumps(dados, ensure_ascii=False, separators=(',', ':'))
+
+class MetricasIA:
+    """Totais de tokens e latência das chamadas à IA, compartilhados entre as sessões"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totais = {"requisicoes": 0, "tokens_entrada": 0, "tokens_saida": 0, "latencia_total_seg": 0.0}
+
+    def registrar(self, uso):
+        with self._lock:
+            self._totais["requisicoes"] += 1
+            self._totais["tokens_entrada"] += uso["tokens_entrada"]
+            self._totais["tokens_saida"] += uso["tokens_saida"]
+            self._totais["latencia_total_seg"] += uso["latencia_seg"]
+
+    def resumo(self):
+        with self._lock:
+            m = dict(self._totais)
+        n = m["requisicoes"] or 1
+        m["tokens_entrada_medio"] = round(m["tokens_entrada"] / n)
+        m["tokens_saida_medio"] = round(m["tokens_saida"] / n)
+        m["latencia_media_seg"] = round(m["latencia_total_seg"] / n, 2)
+        return m
+
+@st.cache_resource
+def obter_metricas_ia():
+    """Instância única por processo do servidor, compartilhada entre as sessões"""
+    return MetricasIA()
+
+def aceita_system_instruction(modelo):
+    """Modelos da família Gemma recusam instrução de sistema (developer instruction)"""
+    return 'gemma' not in modelo.lower()
+
+def gerar_conteudo_ia(modelo, conteudo, com_system_instruction):
+    if com_system_instruction:
+        return genai.GenerativeModel(modelo, system_instruction=SYSTEM_INSTRUCTION_IA).generate_content(conteudo)
+    return genai.GenerativeModel(modelo).generate_content(f"{SYSTEM_INSTRUCTION_IA}\n\n{conteudo}")
+
 def consultar_ia_financeira(api_key, modelo_escolhido, kpis, dados_dre, nome_empresa, cnpj_empresa, periodo_analise, dre_ant=None, kpis_ant=None):
+    # Limpa o uso anterior para que um erro não exiba tokens/latência da chamada passada
+    st.session_state.pop('uso_ia', None)
     if not api_key: return "⚠️ Insira a chave API."
-    contexto = f"Empresa: {nome_empresa} (CNPJ: {cnpj_empresa})\nPeríodo Analisado: {periodo_analise}"
-    bloco_comparativo = ""
-    if dre_ant and kpis_ant:
-        def calc_var(atual, anterior):
-            if anterior == 0: return 0.0
-            return ((atual - anterior) / anterior) * 100
-        var_rec = calc_var(dados_dre.receita_liquida, dre_ant.receita_liquida)
-        var_lucro = calc_var(dados_dre.lucro_liquido, dre_ant.lucro_liquido)
-        var_ebit = calc_var(dados_dre.resultado_operacional, dre_ant.resultado_operacional)
-        bloco_comparativo = f"""
-        DADOS HISTÓRICOS (PERÍODO ANTERIOR) PARA COMPARAÇÃO:
-        - Receita Líquida Anterior: R$ {dre_ant.receita_liquida:,.2f} (Variação Atual: {var_rec:+.2f}%)
-        - Lucro Líquido Anterior: R$ {dre_ant.lucro_liquido:,.2f} (Variação Atual: {var_lucro:+.2f}%)
-        - EBIT Anterior: R$ {dre_ant.resultado_operacional:,.2f} (Variação Atual: {var_ebit:+.2f}%)
-        - Margem Líquida Anterior: {kpis_ant['Margem Líquida (%)']:.1f}%
-        
-        INSTRUÇÃO ADICIONAL:
-        - Você DEVE criar uma seção específica comparando os dois períodos.
-        """
-    
-    # Prompt para a IA
-    prompt = f"""
-    {contexto}
-    Atue como um Analista Financeiro da INOVALENIN.
-    Sua tarefa é gerar um Relatório Gerencial detalhado.
-    DADOS DO PERÍODO ATUAL:
-    - Liquidez Corrente: {kpis['Liquidez Corrente']:.2f}
-    - Liquidez Geral: {kpis['Liquidez Geral']:.2f}
-    - Endividamento Geral: {kpis['Endividamento Geral (%)']:.1f}%
-    - Receita Líquida: R$ {dados_dre.receita_liquida:,.2f}
-    - Lucro Bruto: R$ {dados_dre.lucro_bruto:,.2f} (Margem: {kpis['Margem Bruta (%)']:.1f}%)
-    - Resultado Operacional (EBIT): R$ {dados_dre.resultado_operacional:,.2f} (Margem: {kpis['Margem Operacional (%)']:.1f}%)
-    - Lucro Líquido: R$ {dados_dre.lucro_liquido:,.2f} (Margem: {kpis['Margem Líquida (%)']:.1f}%)
-    - GAO: {kpis['GAO (Alavancagem)']:.2f}
-    {bloco_comparativo}
-    ESTRUTURA OBRIGATÓRIA (Markdown):
-    # 1. Identificação e Contexto
-    [Cite Nome, CNPJ e Período]
-    # 2. Análise da Saúde Financeira (Liquidez e Endividamento)
-    [Análise focada em solvência]
-    # 3. Análise de Performance Operacional (DRE)
-    [Análise de margens, custos e lucro]
-    # 4. Análise de Evolução (Comparativo)
-    [Se houver dados, compare. Senão, analise sustentabilidade.]
-    # 5. Conclusão Técnica e Recomendações
-    ## 5.1 Plano de Ação Imediato
-    ---
-    Recomendamos que este relatório seja discutido com a contabilidade da empresa. Acesse www.inovalenin.com.br.
-    """
+    conteudo = montar_dados_ia(kpis, dados_dre, nome_empresa, cnpj_empresa, periodo_analise, dre_ant, kpis_ant)
     try:
         genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(modelo_escolhido)
-        return model.generate_content(prompt).text
+        com_system = aceita_system_instruction(modelo_escolhido)
+        inicio = time.monotonic()
+        try:
+            resposta = gerar_conteudo_ia(modelo_escolhido, conteudo, com_system)
+        except google_exceptions.InvalidArgument as e:
+            # Modelo recusou a instrução de sistema: reenvia com a instrução junto do conteúdo
+            if not com_system or 'instruction' not in str(e).lower(): raise
+            # A latência registrada é só a da chamada que respondeu
+            inicio = time.monotonic()
+            resposta = gerar_conteudo_ia(modelo_escolhido, conteudo, False)
+        meta = getattr(resposta, 'usage_metadata', None)
+        uso = {
+            "modelo": modelo_escolhido,
+            "tokens_entrada": getattr(meta, 'prompt_token_count', 0) or 0,
+            "tokens_saida": getattr(meta, 'candidates_token_count', 0) or 0,
+            "latencia_seg": round(time.monotonic() - inicio, 2),
+        }
+        st.session_state['uso_ia'] = uso
+        obter_metricas_ia().registrar(uso)
+        return resposta.text
     except Exception as e:
         return f"Erro IA: {str(e)}"
 
@@ -434,11 +518,173 @@ def gerar_pdf_final(texto_ia, nome, cnpj, periodo, dre: DRE, bp: BalancoPatrimon
         pdf.cell(30, 6, formatar_moeda(val), 1, 1, 'R')
     return pdf.output(dest='S').encode('latin-1')
 
+# --- CONTROLE DE ADMISSÃO ---
+# Valores padrão; podem ser sobrescritos nas seções [limites] (leitura de arquivos)
+# e [limites_relatorio] (relatórios IA) do secrets.toml
+LIMITES_PADRAO = {
+    "max_mb": 20,
+    "max_paginas": 60,
+    "max_paralelo": 2,
+    "max_fila": 10,
+    "espera_max_seg": 120,
+    "cota_usuario_hora": 30,
+}
+LIMITES_RELATORIO_PADRAO = {
+    "max_paralelo": 4,
+    "max_fila": 20,
+    "espera_max_seg": 180,
+    "cota_usuario_hora": 10,
+}
+
+# Erros de arquivo corrompido/formato inválido: repetir a leitura não muda o resultado
+ERROS_ARQUIVO_INVALIDO = (PdfminerException, PSException, BadZipFile, InvalidFileException)
+
+class AdmissaoNegada(Exception):
+    """Pedido recusado pelo controle de admissão (mensagem pronta para o usuário)"""
+    def __init__(self, mensagem, definitiva=False):
+        super().__init__(mensagem)
+        # definitiva: o mesmo arquivo será sempre recusado (tamanho/páginas); cota e fila mudam com o tempo
+        self.definitiva = definitiva
+
+class ControleAdmissao:
+    """Limites compartilhados por todas as sessões do servidor: tamanho e páginas por upload,
+    processamentos simultâneos (fila FIFO) e cota de processamentos por usuário a cada hora.
+    max_mb/max_paginas = 0 desativam os limites de arquivo (ex.: controle dos relatórios)."""
+    def __init__(self, max_paralelo, max_fila, espera_max_seg, cota_usuario_hora, max_mb=0, max_paginas=0, rotulo="processamentos"):
+        self.rotulo = rotulo
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_paginas = max_paginas
+        self.max_paralelo = max_paralelo
+        self.max_fila = max_fila
+        self.espera_max_seg = espera_max_seg
+        self.cota_usuario_hora = cota_usuario_hora
+        self._cond = threading.Condition()
+        self._fila = deque()
+        self._ativos = 0
+        self._uso = defaultdict(deque)
+        self._metricas = {
+            "admitidos": 0, "rejeitados_tamanho": 0, "rejeitados_paginas": 0,
+            "rejeitados_cota": 0, "rejeitados_fila": 0, "tempo_esgotado": 0,
+            "pico_paralelo": 0, "pico_fila": 0, "espera_total_seg": 0.0, "execucao_total_seg": 0.0,
+        }
+
+    def _rejeitar(self, motivo, mensagem):
+        with self._cond:
+            self._metricas[motivo] += 1
+        raise AdmissaoNegada(mensagem, definitiva=True)
+
+    def verificar_tamanho(self, n_bytes):
+        if self.max_bytes and n_bytes > self.max_bytes:
+            self._rejeitar("rejeitados_tamanho", f"Arquivo de {n_bytes / 1048576:.1f} MB excede o limite de {self.max_bytes / 1048576:.0f} MB.")
+
+    def verificar_paginas(self, n_paginas):
+        if self.max_paginas and n_paginas > self.max_paginas:
+            self._rejeitar("rejeitados_paginas", f"PDF com {n_paginas} páginas excede o limite de {self.max_paginas} páginas.")
+
+    def _checar_cota(self, usuario, agora):
+        uso = self._uso[usuario]
+        while uso and agora - uso[0] > 3600: uso.popleft()
+        if len(uso) >= self.cota_usuario_hora:
+            self._metricas["rejeitados_cota"] += 1
+            minutos = int((3600 - (agora - uso[0])) // 60) + 1
+            raise AdmissaoNegada(f"Cota de {self.cota_usuario_hora} {self.rotulo}/hora atingida. Tente novamente em {minutos} min.")
+
+    @contextmanager
+    def slot(self, usuario, aviso_fila=None):
+        """Reserva uma vaga de processamento; aviso_fila(posicao) é chamado enquanto aguarda na fila"""
+        ticket = object()
+        inicio = time.monotonic()
+        with self._cond:
+            self._checar_cota(usuario, time.time())
+            if len(self._fila) >= self.max_fila:
+                self._metricas["rejeitados_fila"] += 1
+                raise AdmissaoNegada("Servidor ocupado no momento. Tente novamente em instantes.")
+            self._fila.append(ticket)
+            self._metricas["pico_fila"] = max(self._metricas["pico_fila"], len(self._fila))
+        try:
+            while True:
+                with self._cond:
+                    if self._fila[0] is ticket and self._ativos < self.max_paralelo:
+                        # Revalida a cota na admissão: outras abas do mesmo usuário podem ter sido admitidas na espera
+                        self._checar_cota(usuario, time.time())
+                        self._fila.popleft()
+                        self._ativos += 1
+                        self._uso[usuario].append(time.time())
+                        self._metricas["admitidos"] += 1
+                        self._metricas["pico_paralelo"] = max(self._metricas["pico_paralelo"], self._ativos)
+                        self._metricas["espera_total_seg"] += time.monotonic() - inicio
+                        self._cond.notify_all()
+                        break
+                    if time.monotonic() - inicio > self.espera_max_seg:
+                        self._metricas["tempo_esgotado"] += 1
+                        raise AdmissaoNegada("Tempo de espera na fila esgotado. Tente novamente em instantes.")
+                    posicao = self._fila.index(ticket) + 1
+                    self._cond.wait(0.5)
+                # Fora do lock: no Streamlit o aviso pode levantar a exceção de rerun/stop da sessão
+                if aviso_fila: aviso_fila(posicao)
+        except BaseException:
+            # Sai da fila em qualquer saída antecipada (tempo esgotado, rerun, aba fechada)
+            with self._cond:
+                if ticket in self._fila: self._fila.remove(ticket)
+                self._cond.notify_all()
+            raise
+        inicio_exec = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._ativos -= 1
+                self._metricas["execucao_total_seg"] += time.monotonic() - inicio_exec
+                self._cond.notify_all()
+
+    def metricas(self):
+        with self._cond:
+            m = dict(self._metricas)
+            m["em_execucao"] = self._ativos
+            m["na_fila"] = len(self._fila)
+            m["usuarios_ultima_hora"] = sum(1 for uso in self._uso.values() if uso and time.time() - uso[-1] <= 3600)
+        admitidos = m["admitidos"] or 1
+        m["espera_media_seg"] = round(m["espera_total_seg"] / admitidos, 2)
+        m["execucao_media_seg"] = round(m["execucao_total_seg"] / admitidos, 2)
+        return m
+
+def carregar_limites(padrao, secao):
+    """Aplica a seção do secrets.toml sobre os padrões; chaves desconhecidas são ignoradas com aviso no log"""
+    limites = dict(padrao)
+    for chave, valor in st.secrets.get(secao, {}).items():
+        if chave in padrao: limites[chave] = valor
+        else: logging.getLogger(__name__).warning("[%s] chave desconhecida ignorada: %s", secao, chave)
+    return limites
+
+@st.cache_resource
+def obter_controle_admissao():
+    """Leitura de arquivos: instância única por processo do servidor, compartilhada entre as sessões"""
+    return ControleAdmissao(**carregar_limites(LIMITES_PADRAO, "limites"))
+
+@st.cache_resource
+def obter_controle_relatorios():
+    """Relatórios IA (chamada de rede longa): vagas e cota próprias, sem ocupar a leitura de arquivos"""
+    return ControleAdmissao(**carregar_limites(LIMITES_RELATORIO_PADRAO, "limites_relatorio"), rotulo="relatórios")
+
+def aviso_fila_em(placeholder):
+    return lambda posicao: placeholder.info(f"⏳ Servidor ocupado: você é o {posicao}º da fila...")
+
 # --- extração de dados Não Altere isso ---
+# Sufixo de natureza do saldo (D = devedor, C = credor) logo após o número
+RX_SUFIXO_DC = r"(?<=[\d)])\s*([DdCc])$"
+
 def parse_br_currency(valor_str):
     if not valor_str: return 0.0
     if isinstance(valor_str, (int, float)): return float(valor_str)
-    limpo = re.sub(r'[a-zA-Z\s]', '', str(valor_str))
+    return _parse_br_token(str(valor_str).strip())
+
+@lru_cache(maxsize=4096)
+def _parse_br_token(texto):
+    """Converte um token BR ("1.234,56", "(12.345,00)", "1.234,56 D") em float, com memo LRU"""
+    texto = re.sub(RX_SUFIXO_DC, '', texto)
+    limpo = re.sub(r'[a-zA-Z\s]', '', texto)
+    negativo = limpo.startswith('(') and limpo.endswith(')')
+    if negativo: limpo = limpo[1:-1]
     if ',' in limpo and '.' in limpo:
         limpo = limpo.replace('.', '').replace(',', '.')
     elif limpo.count('.') == 1 and ',' not in limpo:
@@ -447,9 +693,62 @@ def parse_br_currency(valor_str):
     elif ',' in limpo:
          limpo = limpo.replace(',', '.')
     try:
-        return float(limpo)
-    except:
+        valor = float(limpo)
+    except ValueError:
         return 0.0
+    return -valor if negativo else valor
+
+def parse_br_currency_lote(valores):
+    """Converte em lote uma lista/coluna de valores BR em array float, com as regras de parse_br_currency.
+    Tokens repetidos são convertidos uma única vez. O sufixo D/C só indica a natureza do saldo e não muda o sinal.
+    Diferença para o escalar: None/NaN viram 0.0 (parse_br_currency devolve nan para NaN)."""
+    serie = pd.Series(valores, dtype=object)
+    codigos, unicos = pd.factorize(serie)
+    unicos = pd.Series(unicos, dtype=object)
+    eh_texto = unicos.map(lambda v: isinstance(v, str)).astype(bool)
+    # Cópia explícita: com copy-on-write (pandas 3) o to_numpy() é somente leitura
+    resultado = np.array(pd.to_numeric(unicos.mask(eh_texto), errors='coerce').fillna(0.0), dtype=float)
+
+    if eh_texto.any():
+        txt = unicos[eh_texto].astype(str).str.strip()
+        limpo = txt.str.replace(RX_SUFIXO_DC, '', regex=True).str.replace(r'[a-zA-Z\s]', '', regex=True)
+        negativo = limpo.str.startswith('(') & limpo.str.endswith(')')
+        limpo = limpo.mask(negativo, limpo.str[1:-1])
+
+        tem_virgula = limpo.str.contains(',', regex=False)
+        n_pontos = limpo.str.count(r'\.')
+        separador_milhar = (tem_virgula & (n_pontos > 0)) | (
+            ~tem_virgula & (n_pontos == 1) & (limpo.str.rsplit('.', n=1).str[-1].str.len() != 2))
+        limpo = limpo.mask(separador_milhar, limpo.str.replace('.', '', regex=False))
+        limpo = limpo.str.replace(',', '.', regex=False)
+
+        sinal = np.where(negativo, -1.0, 1.0)
+        valores_txt = pd.to_numeric(limpo, errors='coerce').fillna(0.0).to_numpy(dtype=float)
+        resultado[eh_texto.to_numpy()] = valores_txt * sinal
+    # Código -1 (None/NaN) aponta para o 0.0 anexado ao final
+    return np.append(resultado, 0.0)[codigos]
+
+# Célula com valor monetário BR completo: "1.234,56", "(1.234,56)", "-1.234,56 D"
+RX_CELULA_BR = r"^\(?-?(?:\d{1,3}(?:\.\d{3})+|\d+),\d{2}\)?(?:\s*[DdCc])?$"
+
+def normalizar_planilha(df):
+    """Converte em lote as colunas de valores da planilha e as reescreve no padrão BR (sem ambiguidade para a extração)"""
+    df = df.copy()
+    for col in df.columns:
+        serie = df[col]
+        if pd.api.types.is_float_dtype(serie):
+            mascara = serie.notna()
+            valores = serie.to_numpy(dtype=float)
+        elif pd.api.types.is_object_dtype(serie) or pd.api.types.is_string_dtype(serie):
+            eh_float = serie.map(lambda v: isinstance(v, float)).astype(bool)
+            mascara = serie.notna() & (eh_float | serie.astype(str).str.strip().str.match(RX_CELULA_BR))
+            if not mascara.any(): continue
+            valores = parse_br_currency_lote(serie.where(mascara))
+        else:
+            continue
+        formatados = pd.Series(valores, index=serie.index).map(formatar_valor_br)
+        df[col] = serie.astype(object).where(~mascara, formatados)
+    return df
 
 def extrair_periodo_inteligente(texto_completo):
     match_periodo = re.search(r"(?:Período|Exercício|Competência)\s*[:\s-]+\s*((?:\d{1,2}[\/\s]+)?\d{4})", texto_completo, re.IGNORECASE)
@@ -470,10 +769,11 @@ def extrair_periodo_inteligente(texto_completo):
     return ""
 
 def extrair_dados_texto(texto_completo):
-    rx_valor = r"([\d\.,]+)\s*[DC]?" 
+    # Captura parênteses (negativo) e sufixo D/C junto do número para o parser
+    rx_valor = r"(\(?[\d\.,]+\)?(?:\s*[DC]\b)?)"
     txt_bp = texto_completo[:int(len(texto_completo)*0.6)]
     txt_dre = texto_completo[int(len(texto_completo)*0.4):]
-    def buscar_valor(labels, texto_alvo, avoid=[]):
+    def buscar_valor(labels, texto_alvo, avoid=[], com_sinal=False):
         for label in labels:
             pattern = re.compile(f"{label}.*?{rx_valor}", re.IGNORECASE | re.DOTALL)
             match = pattern.search(texto_alvo)
@@ -483,7 +783,9 @@ def extrair_dados_texto(texto_completo):
                 val_str = match.group(1)
                 if val_str in ['2023', '2024', '2025']: continue
                 val = parse_br_currency(val_str)
-                if val > 0: return val
+                # Deduções, custos e despesas costumam vir entre parênteses: só resultados mantêm o sinal
+                if not com_sinal: val = abs(val)
+                if val != 0: return val
         return 0.0
     ac = buscar_valor(["ATIVO CIRCULANTE"], txt_bp, avoid=["TOTAL", "PASSIVO"]) or buscar_valor(["Total do Ativo Circulante"], txt_bp)
     pc = buscar_valor(["PASSIVO CIRCULANTE"], txt_bp, avoid=["TOTAL", "ATIVO"]) or buscar_valor(["Total do Passivo Circulante"], txt_bp)
@@ -497,16 +799,16 @@ def extrair_dados_texto(texto_completo):
     rl = buscar_valor(["RECEITA LIQUIDA"], txt_dre)
     if rl == 0 and rb > 0: rl = rb - ded
     custos = buscar_valor(["CUSTO DAS MERCADORIAS", "CUSTO DOS PRODUTOS", "CUSTO DOS SERVICOS", "CPV", "CMV"], txt_dre)
-    lb = buscar_valor(["LUCRO BRUTO", "RESULTADO BRUTO"], txt_dre)
+    lb = buscar_valor(["LUCRO BRUTO", "RESULTADO BRUTO"], txt_dre, com_sinal=True)
     if lb == 0: lb = rl - custos
     desp_op = buscar_valor(["DESPESAS OPERACIONAIS", "TOTAL DAS DESPESAS"], txt_dre)
-    res_op = buscar_valor(["RESULTADO OPERACIONAL", "LUCRO OPERACIONAL"], txt_dre)
-    ll = buscar_valor(["LUCRO DO PERIODO", "LUCRO LIQUIDO DO EXERCICIO"], txt_dre)
+    res_op = buscar_valor(["RESULTADO OPERACIONAL", "LUCRO OPERACIONAL"], txt_dre, com_sinal=True)
+    ll = buscar_valor(["LUCRO DO PERIODO", "LUCRO LIQUIDO DO EXERCICIO"], txt_dre, com_sinal=True)
     if ll == 0:
         prej = buscar_valor(["PREJUIZO DO PERIODO"], txt_dre)
         if prej > 0: ll = -prej
     if ll == 0:
-        ll = buscar_valor(["LUCRO DO PERIODO", "LUCRO LIQUIDO DO EXERCICIO"], txt_dre)
+        ll = buscar_valor(["LUCRO DO PERIODO", "LUCRO LIQUIDO DO EXERCICIO"], txt_dre, com_sinal=True)
         if ll == 0:
             linhas_dre = txt_dre.split('\n')
             for linha in reversed(linhas_dre):
@@ -520,16 +822,33 @@ def extrair_dados_texto(texto_completo):
 def processar_arquivo(uploaded_file):
     if uploaded_file is None: return None, None
     texto_full = ""
+    controle = obter_controle_admissao()
+    usuario = st.session_state.get('username', '')
+    aviso = st.empty()
     try:
+        controle.verificar_tamanho(uploaded_file.size)
         if uploaded_file.name.endswith('.pdf'):
             with pdfplumber.open(uploaded_file) as pdf:
-                for page in pdf.pages: texto_full += page.extract_text() + "\n"
+                controle.verificar_paginas(len(pdf.pages))
+                with controle.slot(usuario, aviso_fila_em(aviso)):
+                    for page in pdf.pages: texto_full += page.extract_text() + "\n"
         elif uploaded_file.name.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(uploaded_file)
-            texto_full = df.to_string()
+            with controle.slot(usuario, aviso_fila_em(aviso)):
+                df = pd.read_excel(uploaded_file)
+                texto_full = normalizar_planilha(df).to_string()
+    except AdmissaoNegada as e:
+        aviso.empty()
+        st.error(f"🚫 {e}")
+        # Recusas por tamanho/páginas não mudam: não reabre o arquivo nem recontabiliza a cada rerun
+        if e.definitiva: st.session_state.setdefault('arquivos_recusados', {})[chave_arquivo(uploaded_file)] = f"🚫 {e}"
+        return None, None
     except Exception as e:
+        aviso.empty()
         st.error(f"Erro ao ler arquivo: {e}")
+        # Só memoriza falhas permanentes (arquivo inválido); as demais são tentadas de novo no próximo rerun
+        if isinstance(e, ERROS_ARQUIVO_INVALIDO): st.session_state.setdefault('arquivos_recusados', {})[chave_arquivo(uploaded_file)] = f"Erro ao ler arquivo: {e}"
         return None, None
+    aviso.empty()
     nome = "Empresa Analisada"
     match_nome = re.search(r"(?:Nome|Empresa)\s*[:\n-]+\s*(.{5,60})", texto_full, re.IGNORECASE)
     if match_nome: nome = match_nome.group(1).strip().split('\n')[0]
@@ -543,6 +862,24 @@ def processar_arquivo(uploaded_file):
     }
     return dados, (nome, cnpj, periodo)
 
+def chave_arquivo(uploaded_file):
+    return getattr(uploaded_file, 'file_id', None) or (uploaded_file.name, uploaded_file.size)
+
+def carregar_arquivo(uploaded_file):
+    """Processa cada upload uma única vez por sessão; reruns reaproveitam o resultado ou a recusa"""
+    cache = st.session_state.setdefault('arquivos_processados', {})
+    recusados = st.session_state.setdefault('arquivos_recusados', {})
+    chave = chave_arquivo(uploaded_file)
+    if chave in recusados:
+        st.error(recusados[chave])
+        return None, None
+    if chave not in cache:
+        dados, info = processar_arquivo(uploaded_file)
+        if not dados: return None, None
+        cache[chave] = (dados, info)
+    dados, info = cache[chave]
+    return copy.deepcopy(dados), info
+
 # --- Interface ---
 def main():
     if 'uploader_key' not in st.session_state: st.session_state['uploader_key'] = 0
@@ -569,6 +906,9 @@ def main():
         if st.button("🗑️ Limpar / Nova Análise", use_container_width=True):
             st.session_state['uploader_key'] += 1
             st.session_state['relatorio_gerado'] = ""
+            st.session_state['arquivos_processados'] = {}
+            st.session_state['arquivos_recusados'] = {}
+            st.session_state.pop('uso_ia', None)
             for k in ['id_nome', 'id_cnpj', 'id_periodo']: st.session_state[k] = ""
             st.rerun()
         
@@ -583,6 +923,13 @@ def main():
                 
                 opcoes = listar_modelos_disponiveis(api_key) if api_key else []
                 modelo = st.selectbox("Modelo IA:", opcoes, index=0) if opcoes else None
+            with st.expander("📈 Métricas de Admissão"):
+                st.write("Leitura de arquivos")
+                st.json(obter_controle_admissao().metricas())
+                st.write("Relatórios IA")
+                st.json(obter_controle_relatorios().metricas())
+            with st.expander("🤖 Métricas de IA (Tokens)"):
+                st.json(obter_metricas_ia().resumo())
         else:
             # Para clientes acesso, melhorar na versão final
             api_key = st.secrets.get("GOOGLE_API_KEY", "")
@@ -591,13 +938,13 @@ def main():
         # Inicio de dados
         dados_iniciais, dados_anterior = None, None
         if uploaded_file:
-            dados_iniciais, info = processar_arquivo(uploaded_file)
+            dados_iniciais, info = carregar_arquivo(uploaded_file)
             if dados_iniciais:
                 if not st.session_state['id_nome']: st.session_state['id_nome'] = info[0]
                 if not st.session_state['id_cnpj']: st.session_state['id_cnpj'] = info[1]
                 if not st.session_state['id_periodo']: st.session_state['id_periodo'] = info[2]
         if uploaded_file_ant:
-            dados_anterior, _ = processar_arquivo(uploaded_file_ant)
+            dados_anterior, _ = carregar_arquivo(uploaded_file_ant)
 
         # Identificação
         st.write("🏢 **Identificação**")
@@ -706,15 +1053,25 @@ def main():
         if not periodo_final:
             st.warning("⚠️ Informe o PERÍODO no menu lateral.")
         elif modelo and api_key:
-            with st.spinner(f"Processando análise..."):
-                texto_ia = consultar_ia_financeira(api_key, modelo, kpis, dre, nome_final, cnpj_final, periodo_final, dre_ant, kpis_ant)
-                st.session_state['relatorio_gerado'] = texto_ia
+            aviso = st.empty()
+            try:
+                with obter_controle_relatorios().slot(st.session_state['username'], aviso_fila_em(aviso)):
+                    aviso.empty()
+                    with st.spinner(f"Processando análise..."):
+                        texto_ia = consultar_ia_financeira(api_key, modelo, kpis, dre, nome_final, cnpj_final, periodo_final, dre_ant, kpis_ant)
+                        st.session_state['relatorio_gerado'] = texto_ia
+            except AdmissaoNegada as e:
+                aviso.empty()
+                st.error(f"🚫 {e}")
         else:
             st.error("Erro de API Key.")
 
     if st.session_state['relatorio_gerado']:
         with st.container(border=True):
             st.markdown(st.session_state['relatorio_gerado'])
+        if st.session_state.get('user_role') == 'admin' and 'uso_ia' in st.session_state:
+            uso = st.session_state['uso_ia']
+            st.caption(f"🤖 {uso['modelo']} | Tokens entrada: {uso['tokens_entrada']} | saída: {uso['tokens_saida']} | {uso['latencia_seg']:.2f}s")
         
         pdf_bytes = gerar_pdf_final(st.session_state['relatorio_gerado'], nome_final, cnpj_final, periodo_final, dre, bp)
         st.download_button(label="📥 Baixar PDF Completo", data=pdf_bytes, file_name=f"Analise_{nome_final}.pdf", mime='application/pdf')